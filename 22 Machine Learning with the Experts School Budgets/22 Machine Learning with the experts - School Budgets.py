@@ -309,12 +309,13 @@ prediction_df = pd.DataFrame(columns=pd.get_dummies(df[LABELS]).columns,
                              data=predictions)
 
 
-# Save prediction_df to csv
-prediction_df.to_csv('data/predictions.csv')
+# Save prediction_df as a memory-mappable .npy (much faster than csv)
+from scoresubmission import write_predictions
+write_predictions(prediction_df, 'data/predictions.npy')
 
 # Submit the predictions for scoring: score
 
-# score = score_submission(pred_path='data/predictions.csv')
+# score = score_submission(pred_path='data/predictions.npy')
 
 # Print score
 print('Your model, trained with numeric data only, yields logloss score: {}'.format(score))
@@ -1058,7 +1059,7 @@ pl = Pipeline([
                 ]))
              ]
         )),
-        ('int', SparseInteractions(degree=2)),
+        ('int', SparseInteractions(degree=2, dtype=np.float32)),
         ('scale', MaxAbsScaler()),
         ('clf', OneVsRestClassifier(LogisticRegression()))
     ])
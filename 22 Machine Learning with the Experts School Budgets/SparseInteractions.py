@@ -6,51 +6,508 @@ Created on Mon Aug 12 10:27:43 2019
 @author: amin
 """
 
-from itertools import combinations
+import operator
+from collections.abc import Sequence
 
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy import sparse
 from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+
+def _n_combinations(n, k):
+    """ Exact binomial coefficient C(n, k), elementwise for integer arrays. """
+    n = np.asarray(n, dtype=np.int64)
+    out = np.ones_like(n)
+    for j in range(k):
+        out = out * np.maximum(n - j, 0) // (j + 1)
+    return out
+
+
+def _group_arange(counts):
+    """ Concatenation of arange(c) for every c in `counts`. """
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(starts.shape[0]) - starts
+
+
+def _combination_rank(col_ixs, n_cols):
+    """ Position of each column tuple in the order produced by
+        `itertools.combinations(range(n_cols), len(col_ixs))`.
+    """
+    degree = len(col_ixs)
+    rank = np.full(col_ixs[0].shape, _n_combinations(n_cols, degree) - 1, dtype=np.int64)
+    for i, cols in enumerate(col_ixs):
+        rank -= _n_combinations(n_cols - 1 - cols, degree - i)
+    return rank
+
+
+def _first_column_offset(first_col, n_cols, degree):
+    """ Number of `degree`-combinations whose first column is below `first_col`. """
+    return _n_combinations(n_cols, degree) - _n_combinations(n_cols - first_col, degree)
+
+
+def _combination_columns(ranks, n_cols, degree):
+    """ Inverse of `_combination_rank`: the column tuple (one array per
+        position) at each position of `itertools.combinations` order.
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    col_ixs = []
+    prev = np.full(ranks.shape, -1, dtype=np.int64)
+    for i in range(degree):
+        k = degree - i
+        # largest column whose preceding combinations still fit in the rank
+        before = _n_combinations(n_cols - 1 - prev, k)
+        lo, hi = prev + 1, np.full(ranks.shape, n_cols - k, dtype=np.int64)
+        for _ in range(int(n_cols).bit_length()):
+            mid = (lo + hi + 1) // 2
+            fits = before - _n_combinations(n_cols - mid, k) <= ranks
+            lo, hi = np.where(fits, mid, lo), np.where(fits, hi, mid - 1)
+        ranks = ranks - (before - _n_combinations(n_cols - lo, k))
+        col_ixs.append(lo)
+        prev = lo
+    return col_ixs
+
+
+def _as_row_major(X):
+    """ Returns `X` as a CSR matrix with sorted, duplicate-free indices.
+        Canonical CSR input is used as is and dense input is read straight
+        from its non-zero pattern, which np.nonzero yields in row order.
+    """
+    if sparse.issparse(X):
+        if X.format != 'csr':
+            X = X.tocsr()
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        return X
+
+    X = np.asarray(X)
+    rows, cols = np.nonzero(X)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=X.shape[0]))])
+    return sparse.csr_matrix((X[rows, cols], cols, indptr), shape=X.shape)
+
+
+def _expand_row_combinations(X, degree, first_cols=None):
+    """ Takes a CSR matrix `X` with sorted indices and returns, for every
+        `degree`-combination of stored entries sharing a row, that row, the
+        tuple of columns (one array per position) and the product of values.
+        `first_cols` optionally restricts the first column to [start, stop).
+    """
+    row_of_entry = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    row_end = X.indptr[1:][row_of_entry]
+
+    # only start tuples that can still be completed within their row
+    can_start = row_end - np.arange(X.nnz) >= degree
+    if first_cols is not None:
+        can_start &= (X.indices >= first_cols[0]) & (X.indices < first_cols[1])
+    positions = [np.flatnonzero(can_start)]
+    for step in range(1, degree):
+        last = positions[-1]
+        counts = row_end[last] - last - (degree - step)
+        positions = [np.repeat(p, counts) for p in positions]
+        positions.append(np.repeat(last + 1, counts) + _group_arange(counts))
+
+    values = X.data[positions[0]]
+    for p in positions[1:]:
+        values = values * X.data[p]
+
+    return (row_of_entry[positions[0]],
+            [X.indices[p] for p in positions],
+            values)
+
+
+def _interaction_block(X, degree, first_cols=None, kept=None, format='csc'):
+    """ All products of `degree` distinct columns of the CSR matrix `X`, as a
+        `format` ('csc' or 'csr') matrix whose columns follow
+        `itertools.combinations` order. With `first_cols` = (start, stop) only
+        the contiguous slice of that order whose first column lies in
+        [start, stop) is built. With `kept`, a sorted array of combination
+        ranks, only those columns are built.
+    """
+    n_cols = X.shape[1]
+    start, stop = first_cols if first_cols is not None else (0, n_cols)
+    offset = _first_column_offset(start, n_cols, degree)
+    end = _first_column_offset(stop, n_cols, degree)
+
+    rows, col_ixs, values = _expand_row_combinations(X, degree, first_cols)
+    cols = _combination_rank(col_ixs, n_cols)
+
+    if kept is None:
+        n_out = int(end - offset)
+        cols -= offset
+    else:
+        first, last = np.searchsorted(kept, [offset, end])
+        n_out = int(last - first)
+        pos = np.searchsorted(kept, cols)
+        hit = np.append(kept, -1)[pos] == cols
+        rows, values, cols = rows[hit], values[hit], pos[hit] - first
+
+    if format == 'csr':
+        # products come out row by row with increasing ranks, which is
+        # already canonical CSR order
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=X.shape[0]))])
+        return sparse.csr_matrix((values, cols, indptr), shape=(X.shape[0], n_out))
+    return sparse.csc_matrix((values, (rows, cols)), shape=(X.shape[0], n_out))
+
+
+def _merge_counts(pairs):
+    """ Sums (ranks, counts) pairs into one pair of sorted distinct ranks
+        and their total counts.
+    """
+    ranks = np.concatenate([r for r, _ in pairs] + [np.empty(0, dtype=np.int64)])
+    counts = np.concatenate([c for _, c in pairs] + [np.empty(0, dtype=np.int64)])
+    ranks, inverse = np.unique(ranks, return_inverse=True)
+    return ranks, np.bincount(inverse, weights=counts, minlength=ranks.shape[0]).astype(np.int64)
+
+
+def _combination_support(X, degree, row_batches):
+    """ The ranks of the `degree`-combinations of columns non-zero in some
+        row of the CSR matrix `X`, sorted, and the number of such rows for
+        each, counted over the [start, stop) `row_batches` only. Only the
+        combinations that occur are counted, so memory grows with them
+        rather than with all C(n_cols, degree) combinations.
+    """
+    ranks, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pending, n_pending = [], 0
+    for start, stop in row_batches:
+        _, col_ixs, values = _expand_row_combinations(X[start:stop], degree)
+        # a combination occurs at most once per row
+        batch_ranks = _combination_rank([cols[values != 0] for cols in col_ixs], X.shape[1])
+        pending.append(np.unique(batch_ranks, return_counts=True))
+        n_pending += pending[-1][0].shape[0]
+        # merging once the pending pairs outgrow the merged ones keeps
+        # both the memory and the merging work linear
+        if n_pending > ranks.shape[0]:
+            ranks, counts = _merge_counts([(ranks, counts)] + pending)
+            pending, n_pending = [], 0
+    return _merge_counts([(ranks, counts)] + pending)
+
+
+def _split_rows(X, degree, max_products):
+    """ Splits the rows of the CSR matrix `X` into contiguous [start, stop)
+        ranges expanding to about `max_products` `degree`-combinations each.
+    """
+    work = np.cumsum(_n_combinations(np.diff(X.indptr), degree))
+    targets = np.arange(max_products, work[-1] if work.shape[0] else 0, max_products)
+    bounds = np.unique(np.searchsorted(work, targets, side='right'))
+    bounds = np.concatenate([[0], bounds[(bounds > 0) & (bounds < X.shape[0])], [X.shape[0]]])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _hash_combinations(col_ixs, n_features):
+    """ Hashes each column tuple into [0, n_features) with FNV-1a over the
+        column indices followed by a 64-bit finalizer.
+    """
+    h = np.full(col_ixs[0].shape, 0xcbf29ce484222325 ^ len(col_ixs), dtype=np.uint64)
+    for cols in col_ixs:
+        h = (h ^ cols.astype(np.uint64)) * np.uint64(0x100000001b3)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    return (h % np.uint64(n_features)).astype(np.int64)
+
+
+def _hashed_interaction_block(X, degree, n_features, first_cols=None, format='csc'):
+    """ Like `_interaction_block`, but every product is added to one of
+        `n_features` columns chosen by hashing its column tuple.
+    """
+    rows, col_ixs, values = _expand_row_combinations(X, degree, first_cols)
+    cols = _hash_combinations(col_ixs, n_features)
+    block = sparse.coo_matrix((values, (rows, cols)), shape=(X.shape[0], n_features))
+    return block.asformat(format)
+
+
+def _split_first_columns(X, degree, n_chunks):
+    """ Splits the columns of the CSR matrix `X` into at most `n_chunks`
+        contiguous [start, stop) ranges holding about the same number of
+        `degree`-combinations of stored entries when used as first column.
+    """
+    row_end = np.repeat(X.indptr[1:], np.diff(X.indptr))
+    work = _n_combinations(row_end - np.arange(X.nnz) - 1, degree - 1)
+    cum_work = np.cumsum(np.bincount(X.indices, weights=work, minlength=X.shape[1]))
+
+    targets = np.linspace(0, cum_work[-1], n_chunks + 1)[1:-1]
+    bounds = np.unique(np.searchsorted(cum_work, targets, side='right'))
+    bounds = np.concatenate([[0], bounds[(bounds > 0) & (bounds < X.shape[1])], [X.shape[1]]])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class _InteractionNames(Sequence):
+    """ Read-only sequence of the output column names of a fitted
+        SparseInteractions, built on access from the original column names
+        and the int32 column tuples instead of being stored as strings.
+        Degrees without tuples (None) keep every combination, and their
+        tuples are unranked only for the names asked for.
+    """
+    def __init__(self, orig_col_names, separator, interactions=None,
+                 interaction_ranks=None, n_hashed=None):
+        self.orig_col_names = np.asarray(orig_col_names).astype(str)
+        self.separator = separator
+        self.interactions = interactions
+        self.interaction_ranks = interaction_ranks
+        self.n_hashed = n_hashed
+
+        sizes = [self.orig_col_names.shape[0]]
+        if n_hashed is not None:
+            sizes.append(n_hashed)
+        else:
+            n_cols = self.orig_col_names.shape[0]
+            sizes += [_n_combinations(n_cols, degree) if ixs is None else ixs.shape[0]
+                      for degree, ixs in enumerate(interactions, 2)]
+        self._offsets = np.cumsum([0] + sizes)
+        self._orig_positions = None
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            positions = np.arange(*i.indices(len(self)))
+            # _names needs ascending positions, so negative steps are reversed
+            if i.step is not None and i.step < 0:
+                return self._names(positions[::-1])[::-1]
+            return self._names(positions)
+
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('feature index out of range')
+
+        return self._names(np.array([i]))[0]
+
+    def _names(self, positions):
+        """ Names at the sorted array of valid `positions`, with the column
+            tuples of each degree looked up or unranked in one go.
+        """
+        names = []
+        bounds = np.searchsorted(positions, self._offsets)
+        for segment in range(len(self._offsets) - 1):
+            local = positions[bounds[segment]:bounds[segment + 1]] - self._offsets[segment]
+            if segment == 0:
+                names += [str(name) for name in self.orig_col_names[local]]
+            elif self.n_hashed is not None:
+                names += ['hash{}{}'.format(self.separator, j) for j in local]
+            else:
+                ixs = self.interactions[segment - 1]
+                if ixs is None:
+                    ixs = np.stack(_combination_columns(local, self.orig_col_names.shape[0],
+                                                        segment + 1), axis=1)
+                else:
+                    ixs = ixs[local]
+                names += [self.separator.join(cols) for cols in self.orig_col_names[ixs]]
+        return names
+
+    def __contains__(self, name):
+        try:
+            self.index(name)
+        except ValueError:
+            return False
+        return True
+
+    def index(self, name):
+        if self._orig_positions is None:
+            self._orig_positions = {n: j for j, n in enumerate(self.orig_col_names)}
+        if name in self._orig_positions:
+            return self._orig_positions[name]
+
+        if self.n_hashed is not None:
+            prefix = 'hash' + self.separator
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                j = int(name[len(prefix):])
+                if j < self.n_hashed:
+                    return int(self._offsets[1]) + j
+            raise ValueError('{!r} is not a feature name'.format(name))
+
+        for col_ixs in self._split_name(name):
+            degree = len(col_ixs)
+            if not 2 <= degree < len(self._offsets) or list(col_ixs) != sorted(set(col_ixs)):
+                continue
+            rank = _combination_rank([np.array([c]) for c in col_ixs],
+                                     self.orig_col_names.shape[0])[0]
+            ranks = self.interaction_ranks[degree - 2]
+            if ranks is not None:
+                pos = np.searchsorted(ranks, rank)
+                if pos == ranks.shape[0] or ranks[pos] != rank:
+                    continue
+                rank = pos
+            return int(self._offsets[degree - 1] + rank)
+
+        raise ValueError('{!r} is not a feature name'.format(name))
+
+    def tolist(self):
+        return self[:]
+
+    def _split_name(self, name):
+        """ Every way of reading `name` as original column names joined by
+            the separator, as tuples of column positions.
+        """
+        if name in self._orig_positions:
+            yield (self._orig_positions[name],)
+        start = name.find(self.separator)
+        while start != -1:
+            head = name[:start]
+            if head in self._orig_positions:
+                for rest in self._split_name(name[start + len(self.separator):]):
+                    yield (self._orig_positions[head],) + rest
+            start = name.find(self.separator, start + 1)
 
 
 class SparseInteractions(BaseEstimator, TransformerMixin):
-    def __init__(self, degree=2, feature_name_separator="_"):
+    def __init__(self, degree=2, feature_name_separator="_", n_jobs=None,
+                 min_support=None, n_features=None, dtype=None):
         self.degree = degree
         self.feature_name_separator = feature_name_separator
+        self.n_jobs = n_jobs
+        self.min_support = min_support
+        self.n_features = n_features
+        self.dtype = dtype
 
     def fit(self, X, y=None):
+        self._fit(X)
         return self
 
     def transform(self, X):
-        if not sparse.isspmatrix_csc(X):
-            X = sparse.csc_matrix(X)
+        check_is_fitted(self, "n_features_in_")
 
-        if hasattr(X, "columns"):
-            self.orig_col_names = X.columns
-        else:
-            self.orig_col_names = np.array([str(i) for i in range(X.shape[1])])
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError('X has {} features, but SparseInteractions was fitted with {}.'
+                             .format(X.shape[1], self.n_features_in_))
 
         spi = self._create_sparse_interactions(X)
         return spi
 
+    def iter_transform(self, X, batch_size=10000):
+        """ Generator over the transformed `X` in blocks of `batch_size` rows,
+            so that only one block of interactions is held in memory at a time,
+            e.g. to feed an estimator's `partial_fit` or an on-disk writer.
+        """
+        check_is_fitted(self, "n_features_in_")
+
+        if hasattr(X, "iloc"):
+            X = X.to_numpy()
+        elif sparse.issparse(X) and X.format != 'csr':
+            X = X.tocsr()
+
+        for start in range(0, X.shape[0], batch_size):
+            yield self.transform(X[start:start + batch_size])
+
     def get_feature_names(self):
         return self.feature_names
 
+    def _fit(self, X):
+        """ Freezes the column layout: the original column names and, per
+            degree, the selected column tuples as int32 arrays, or None when
+            every combination is kept.
+        """
+        if hasattr(X, "columns"):
+            self.orig_col_names = np.asarray(X.columns).astype(str)
+        else:
+            self.orig_col_names = np.array([str(i) for i in range(X.shape[1])])
+
+        self.n_features_in_ = X.shape[1]
+        if self.n_features is not None:
+            if self.min_support is not None:
+                raise ValueError('min_support is not supported together with n_features.')
+            # hashed layout depends only on n_features, nothing to enumerate;
+            # hashed columns have no single source tuple, name them by bucket
+            self.interactions_ = self.interaction_ranks_ = None
+            self.feature_names = _InteractionNames(self.orig_col_names, self.feature_name_separator,
+                                                   n_hashed=self.n_features)
+            return
+
+        self.interactions_ = []
+        self.interaction_ranks_ = []
+
+        if self.min_support is not None:
+            X_rows = self._as_rows(X)
+
+        for sub_degree in range(2, self.degree + 1):
+            if self.min_support is None:
+                # every combination is kept, so the rank is the column
+                self.interactions_.append(None)
+                self.interaction_ranks_.append(None)
+                continue
+
+            # keep the interactions non-zero in at least min_support rows;
+            # only their counts are held, the columns are built on transform
+            ranks, support = self._support(X_rows, sub_degree)
+            kept = ranks[support >= self.min_support]
+            col_ixs = np.stack(_combination_columns(kept, X.shape[1], sub_degree), axis=1)
+            self.interactions_.append(col_ixs.astype(np.int32))
+            self.interaction_ranks_.append(kept)
+
+        self.feature_names = _InteractionNames(self.orig_col_names, self.feature_name_separator,
+                                               self.interactions_, self.interaction_ranks_)
+
+    def _support(self, X, degree):
+        """ `_combination_support` of the CSR matrix `X`, counted over row
+            batches of about 2**18 products, so memory is bound by the
+            distinct combinations rather than by the interactions of all
+            rows. Each job counts every n_jobs-th batch and their counts are
+            merged.
+        """
+        batches = _split_rows(X, degree, 1 << 18)
+        n_jobs = min(effective_n_jobs(self.n_jobs), len(batches))
+        if n_jobs == 1:
+            return _combination_support(X, degree, batches)
+
+        counts = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(_combination_support)(X, degree, batches[k::n_jobs]) for k in range(n_jobs))
+        return _merge_counts(counts)
+
+    def _as_rows(self, X):
+        """ `X` as canonical CSR in the output dtype, so that products are
+            computed in that dtype rather than upcast afterwards.
+        """
+        X_rows = _as_row_major(X)
+        if self.dtype is not None:
+            X_rows = X_rows.astype(self.dtype, copy=False)
+        return X_rows
+
+    def _output_base(self, X, X_rows):
+        """ The original columns to lead the output with and the output
+            format: CSC input stays CSC, CSR and dense input come out as CSR.
+        """
+        if sparse.issparse(X) and X.format == 'csc':
+            return X.astype(X_rows.dtype, copy=False), 'csc'
+        return X_rows, 'csr'
+
     def _create_sparse_interactions(self, X):
         out_mat = []
-        self.feature_names = self.orig_col_names.tolist()
 
-        for sub_degree in range(2, self.degree + 1):
-            for col_ixs in combinations(range(X.shape[1]), sub_degree):
-                # add name for new column
-                name = self.feature_name_separator.join(self.orig_col_names[list(col_ixs)])
-                self.feature_names.append(name)
+        # build each degree in one pass over the rows instead of one
+        # column product at a time
+        X_rows = self._as_rows(X)
+        X_out, out_format = self._output_base(X, X_rows)
+
+        if self.n_features is not None:
+            # every degree shares the same hashed columns
+            hashed = sparse.csr_matrix((X.shape[0], self.n_features), dtype=X_rows.dtype)
+            for sub_degree in range(2, self.degree + 1):
+                for block in self._interaction_blocks(X_rows, sub_degree, format='csr'):
+                    hashed = hashed + block
+            return sparse.hstack([X_out, hashed], format=out_format)
+
+        for sub_degree, kept in zip(range(2, self.degree + 1), self.interaction_ranks_):
+            out_mat.extend(self._interaction_blocks(X_rows, sub_degree, kept, out_format))
+
+        return sparse.hstack([X_out] + out_mat, format=out_format)
 
-                # get column multiplications value
-                out = X[:, col_ixs[0]]
-                for j in col_ixs[1:]:
-                    out = out.multiply(X[:, j])
+    def _interaction_blocks(self, X, degree, kept=None, format='csc'):
+        n_jobs = effective_n_jobs(self.n_jobs)
+        if n_jobs == 1 or X.nnz == 0:
+            return [self._interaction_block(X, degree, None, kept, format)]
 
-                out_mat.append(out)
+        # chunks cover consecutive first columns, so their blocks come back
+        # already in combinations order
+        chunks = _split_first_columns(X, degree, n_jobs)
+        return Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(self._interaction_block)(X, degree, first_cols, kept, format)
+            for first_cols in chunks)
 
-        return sparse.hstack([X] + out_mat)
\ No newline at end of file
+    def _interaction_block(self, X, degree, first_cols=None, kept=None, format='csc'):
+        if self.n_features is not None:
+            return _hashed_interaction_block(X, degree, self.n_features, first_cols, format)
+        return _interaction_block(X, degree, first_cols, kept, format)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks SparseInteractions.fit_transform on synthetic matrices shaped
+like the School Budgets features: a few dense numeric columns next to
+token counts whose column popularity falls off like a Zipf law.
+
+Every combination of rows, columns, density and degree is timed and its
+peak traced memory and output size are written as JSON, e.g.
+
+    python benchmark_sparse_interactions.py --rows 10000 100000 \
+        --degrees 2 3 --output bench.json
+"""
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from itertools import product
+
+import numpy as np
+import scipy
+import sklearn
+from scipy import sparse
+
+from SparseInteractions import SparseInteractions
+
+
+def make_budget_like_matrix(n_rows, n_cols, density, n_numeric=2, zipf_exponent=1.1, seed=0):
+    """ Returns a CSR matrix of `n_numeric` dense float columns followed by
+        `n_cols` - `n_numeric` integer token counts with about `density`
+        of their entries non-zero.
+    """
+    rng = np.random.RandomState(seed)
+    n_text = n_cols - n_numeric
+
+    popularity = 1.0 / np.arange(1, n_text + 1) ** zipf_exponent
+    popularity /= popularity.sum()
+
+    row_nnz = rng.poisson(density * n_text, size=n_rows)
+    rows = np.repeat(np.arange(n_rows), row_nnz)
+    cols = rng.choice(n_text, size=rows.shape[0], p=popularity)
+    counts = rng.geometric(0.7, size=rows.shape[0]).astype(np.float64)
+    text = sparse.csr_matrix((counts, (rows, cols)), shape=(n_rows, n_text))
+
+    numeric = sparse.csr_matrix(rng.lognormal(size=(n_rows, n_numeric)))
+    return sparse.hstack([numeric, text], format='csr')
+
+
+def run_case(X, degree, repeats, **params):
+    """ Times `repeats` fit_transform calls and traces the peak memory of
+        one more.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = SparseInteractions(degree=degree, **params).fit_transform(X)
+        times.append(time.perf_counter() - start)
+
+    del out
+    tracemalloc.start()
+    out = SparseInteractions(degree=degree, **params).fit_transform(X)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds_min': min(times),
+            'seconds_median': float(np.median(times)),
+            'peak_memory_bytes': peak,
+            'output_shape': list(out.shape),
+            'output_nnz': int(out.nnz)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--cols', type=int, nargs='+', default=[102, 302])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.005, 0.02])
+    parser.add_argument('--degrees', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--dtype', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='sparse_interactions_benchmark.json')
+    args = parser.parse_args(argv)
+
+    params = {'n_jobs': args.n_jobs, 'dtype': args.dtype}
+    results = []
+    for n_rows, n_cols, density, degree in product(args.rows, args.cols,
+                                                   args.densities, args.degrees):
+        X = make_budget_like_matrix(n_rows, n_cols, density, seed=args.seed)
+        case = {'rows': n_rows, 'cols': n_cols, 'density': density,
+                'degree': degree, 'input_nnz': int(X.nnz)}
+        case.update(run_case(X, degree, args.repeats, **params))
+        results.append(case)
+        print('rows={rows} cols={cols} density={density} degree={degree}: '
+              '{seconds_min:.3f}s, peak {peak_memory_bytes} B, nnz {output_nnz}'.format(**case))
+
+    report = {'created': datetime.now(timezone.utc).isoformat(),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'scipy': scipy.__version__,
+              'sklearn': sklearn.__version__,
+              'seed': args.seed,
+              'repeats': args.repeats,
+              'params': params,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
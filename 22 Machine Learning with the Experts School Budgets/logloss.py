@@ -8,20 +8,120 @@ Created on Sun Aug 11 15:07:10 2019
 
 import numpy as np
 
-def compute_log_loss(predicted, actual, eps=1e-14):
+def compute_log_loss(predicted, actual, eps=1e-14, sample_weight=None):
      """ Computes the logarithmic loss between predicted and
-     actual when these are 1D arrays.
+     actual. 1D arrays give a single loss; 2D arrays of shape
+     (n_rows, n_labels) give one loss per column.
      
      :param predicted: The predicted probabilities as floats between 0-1
      :param actual: The actual binary labels. Either 0 or 1.
      :param eps (optional): log(0) is inf, so we need to offset our
      predicted values slightly by eps from 0 or 1.
+     :param sample_weight (optional): One weight per row, for a
+     weighted mean over the rows.
      """
      
-     predicted = np.clip(predicted, eps, 1 - eps)
+     q = _log_likelihood(predicted, actual, eps)
+     axis = 0 if q.ndim else None
+     if sample_weight is None:
+          loss = -1 * np.mean(q, axis=axis)
+     else:
+          # weight in place rather than through np.average's weighted copy
+          sample_weight = np.asarray(sample_weight, dtype=np.float64)
+          q *= sample_weight.reshape(q.shape[:1] + (1,) * (q.ndim - 1))
+          loss = -1 * q.sum(axis=axis) / sample_weight.sum()
+     
+     return loss
+
+
+def _log_likelihood(predicted, actual, eps):
+     """ Returns the log likelihood of every entry of actual under
+     predicted, in a single new float64 buffer.
+     """
+     predicted = np.asarray(predicted, dtype=np.float64)
+     actual = np.asarray(actual)
+     q = np.empty(np.broadcast(predicted, actual).shape)
+     np.clip(predicted, eps, 1 - eps, out=q)
      # we use the clip function which sets a maximum and minimum value for elements 
      #in an array. Since log of 0 is negative infinity we want to offset our predictions so slightly
      # from being exactly 1 or exactly 0 so that the score remains a real number
-     loss = -1 * np.mean(actual * np.log(predicted) + (1 - actual) * np.log(1 - predicted))
+     is_zero = actual == 0
+     if np.logical_or(is_zero, actual == 1).all():
+          # binary labels only need the log of the probability given to the
+          # observed label, worked out in place in the clipped buffer
+          np.subtract(1, q, out=q, where=is_zero)
+          np.log(q, out=q)
+     else:
+          # soft labels: actual * log(p) + (1 - actual) * log(1 - p)
+          log_rest = np.subtract(1, q)
+          np.log(log_rest, out=log_rest)
+          np.log(q, out=q)
+          q -= log_rest
+          q *= actual
+          q += log_rest
+     return q
+
+
+def _compensated_add(total, compensation, value):
+     """ Adds value to total with Neumaier's compensated summation and
+     returns the new total and compensation. The rounding error of each
+     addition is kept in compensation, so total + compensation stays
+     within rounding of the exact sum however many values are added.
+     """
+     new_total = total + value
+     error = np.where(np.abs(total) >= np.abs(value),
+                      (total - new_total) + value,
+                      (value - new_total) + total)
+     return new_total, compensation + error
+
+
+class LogLossAccumulator(object):
+     """ compute_log_loss over batches of rows, for predictions that
+     arrive in batches and are not kept. Each batch is summed like
+     compute_log_loss sums it and the batch sums are added with
+     compensated summation, so result() matches compute_log_loss on
+     all the rows to within floating point rounding, and exactly for
+     a single batch. Accumulators fed different batches, for example
+     by parallel workers, can be combined with merge().
+     
+     :param eps (optional): As for compute_log_loss.
+     """
+     
+     def __init__(self, eps=1e-14):
+          self.eps = eps
+          self.total = self.total_compensation = 0.0
+          self.weight = self.weight_compensation = 0.0
+     
+     def update(self, predicted, actual, sample_weight=None):
+          """ Adds a batch of rows, 1D or (n_rows, n_labels) like
+          compute_log_loss takes them.
+          """
+          q = _log_likelihood(predicted, actual, self.eps)
+          if sample_weight is None:
+               batch_total = q.sum(axis=0)
+               batch_weight = q.shape[0] if q.ndim else 1
+          else:
+               sample_weight = np.asarray(sample_weight, dtype=np.float64)
+               q *= sample_weight.reshape((-1,) + (1,) * (q.ndim - 1))
+               batch_total = q.sum(axis=0)
+               batch_weight = sample_weight.sum()
+          self.total, self.total_compensation = _compensated_add(
+               self.total, self.total_compensation, batch_total)
+          self.weight, self.weight_compensation = _compensated_add(
+               self.weight, self.weight_compensation, batch_weight)
+          return self
+     
+     def merge(self, other):
+          """ Adds the rows seen by another accumulator to this one. """
+          self.total, self.total_compensation = _compensated_add(
+               self.total, self.total_compensation + other.total_compensation, other.total)
+          self.weight, self.weight_compensation = _compensated_add(
+               self.weight, self.weight_compensation + other.weight_compensation, other.weight)
+          return self
      
-     return loss
\ No newline at end of file
+     def result(self):
+          """ The log loss of all rows added so far. """
+          if not self.weight:
+               raise ValueError("No rows have been added.")
+          return -1 * ((self.total + self.total_compensation) /
+                       (self.weight + self.weight_compensation))
\ No newline at end of file
@@ -10,23 +10,265 @@ from warnings import warn
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy import sparse
+from sklearn.model_selection import BaseCrossValidator
 
-def multilabel_sample(y, size=1000, min_count=5, seed=None):
-    """ Takes a matrix of binary labels `y` and returns
-        the indices for a sample of size `size` if
-        `size` > 1 or `size` * len(y) if size =< 1.
-        The sample is guaranteed to have > `min_count` of
-        each label.
+def _seed_sequence(seed):
+    """ A SeedSequence from `seed`: an int, a SeedSequence, or None for
+        fresh OS entropy.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def _as_label_matrix(y):
+    """ Takes a label matrix `y` as an ndarray, a scipy sparse matrix or a
+        DataFrame with dense or sparse columns and returns (choices, y)
+        where `choices` identifies the rows and `y` is an ndarray or a
+        CSC matrix with sorted, duplicate-free indices.
+    """
+    if isinstance(y, pd.DataFrame):
+        choices = y.index
+        if y.shape[1] and all(isinstance(dtype, pd.SparseDtype) for dtype in y.dtypes):
+            y = y.sparse.to_coo()
+        else:
+            y = y.values
+    else:
+        choices = np.arange(y.shape[0])
+
+    if sparse.issparse(y):
+        y = sparse.csc_matrix(y, copy=True)
+        y.sum_duplicates()
+    return choices, y
+
+
+def _label_values(y):
+    """ Distinct values of the ndarray or CSC matrix `y`, implicit zeros
+        included, without densifying sparse input.
+    """
+    if not sparse.issparse(y):
+        return np.unique(y)
+
+    values = np.unique(y.data)
+    if y.nnz < y.shape[0] * y.shape[1]:
+        values = np.union1d(values, [0])
+    return values
+
+
+def _label_rows(y):
+    """ Takes a binary label matrix `y`, an ndarray or canonical CSC
+        matrix, and returns (ptr, rows) such that rows[ptr[j]:ptr[j + 1]]
+        are the sorted positions of the rows having label j.
+    """
+    if sparse.issparse(y):
+        labels = np.repeat(np.arange(y.shape[1]), np.diff(y.indptr))
+        is_one = y.data == 1
+        rows, labels = y.indices[is_one], labels[is_one]
+    else:
+        rows, labels = np.nonzero(y == 1)
+        # a stable sort keeps the rows of each label in order
+        rows = rows[np.argsort(labels, kind='stable')]
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=y.shape[1]))])
+    return ptr, rows
+
+
+def _row_labels(y):
+    """ Row-major counterpart of `_label_rows`: returns (ptr, labels) such
+        that labels[ptr[i]:ptr[i + 1]] are the labels of row i.
+    """
+    if sparse.issparse(y):
+        y = y.tocsr()
+        rows = np.repeat(np.arange(y.shape[0]), np.diff(y.indptr))
+        is_one = y.data == 1
+        rows, labels = rows[is_one], y.indices[is_one]
+    else:
+        rows, labels = np.nonzero(y == 1)
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=y.shape[0]))])
+    return ptr, labels
+
+
+def _prepare_labels(y, min_count):
+    """ Validates the binary label matrix `y` and returns (choices, y,
+        label_ptr, label_rows), see `_as_label_matrix` and `_label_rows`.
     """
+    choices, y = _as_label_matrix(y)
+
     try:
-        if (np.unique(y).astype(int) != np.array([0, 1])).any():
+        if (_label_values(y).astype(int) != np.array([0, 1])).any():
             raise ValueError()
     except (TypeError, ValueError):
         raise ValueError('multilabel_sample only works with binary indicator matrices')
 
-    if (y.sum(axis=0) < min_count).any():
+    # positions of the rows holding each label, label by label
+    label_ptr, label_rows = _label_rows(y)
+
+    if (np.diff(label_ptr) < min_count).any():
         raise ValueError('Some classes do not have enough examples. Change min_count if necessary.')
 
+    return choices, y, label_ptr, label_rows
+
+
+def _group_arange(counts):
+    """ Concatenation of arange(c) for every c in `counts`. """
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(starts.shape[0]) - starts
+
+
+def _water_fill(desired, tie_break, n_items):
+    """ Number of the `n_items` each fold receives when items go one at a
+        time to the fold with the most desired items left, ties going to
+        the highest `tie_break`.
+    """
+    n_folds = desired.shape[0]
+    if n_items <= 0:
+        return np.zeros(n_folds, dtype=np.int64)
+
+    # the i-th item a fold receives is worth its desired count minus i
+    scores = (desired[:, None] - np.arange(n_items)).ravel()
+    ties = np.repeat(tie_break, n_items)
+    winners = np.lexsort((-ties, -scores))[:n_items]
+    return np.bincount(winners // n_items, minlength=n_folds)
+
+
+def _iterative_stratification(y, label_ptr, label_rows, proportions, min_counts, rng):
+    """ Assigns every row of the validated label matrix `y` to one of
+        len(`proportions`) folds so that each label is split across the
+        folds in about those proportions, with at least `min_counts[f]`
+        examples of every label in fold f.
+
+        First every fold is given the examples it still lacks of each
+        label, rarest label first and preferring rows with few labels, so
+        the balancing pass cannot deal away the rows a rarer label needs.
+        That always succeeds when only one fold has a minimum, as in a
+        train/test split. With several folds a local search repairs what
+        the greedy reservation gets wrong; some label matrices cannot be
+        split at all, and a ValueError is raised for those.
+
+        The balancing then follows the iterative stratification of
+        Sechidis et al. (2011), handling all unassigned rows of the rarest
+        remaining label in one batch, so the work is O(nnz) plus a sort
+        per label.
+    """
+    n_rows, n_labels = y.shape
+    n_folds = len(proportions)
+    proportions = np.asarray(proportions, dtype=np.float64)
+    min_counts = np.asarray(min_counts, dtype=np.int64)
+    row_ptr, row_labels = _row_labels(y)
+
+    # per fold and label: examples still wanted and examples received
+    remaining = np.diff(label_ptr)
+    desired = np.outer(proportions, remaining)
+    desired_total = proportions * n_rows
+    fold_counts = np.zeros((n_folds, n_labels), dtype=np.int64)
+    fold = np.full(n_rows, -1, dtype=np.int64)
+
+    def assign(rows, n_alloc):
+        nonlocal remaining, desired_total
+        row_fold = np.repeat(np.arange(n_folds), n_alloc)
+        fold[rows] = row_fold
+
+        # count the labels of the newly assigned rows towards their fold
+        starts, counts = row_ptr[rows], np.diff(row_ptr)[rows]
+        labels = row_labels[np.repeat(starts, counts) + _group_arange(counts)]
+        added = np.bincount(np.repeat(row_fold, counts) * n_labels + labels,
+                            minlength=n_folds * n_labels).reshape(n_folds, n_labels)
+        fold_counts[:] += added
+        desired[:] -= added
+        desired_total = desired_total - n_alloc
+        remaining = remaining - added.sum(axis=0)
+
+    def move(row, to_fold):
+        nonlocal desired_total
+        from_fold, labels = fold[row], row_labels[row_ptr[row]:row_ptr[row + 1]]
+        if from_fold == -1:
+            return assign(np.array([row]), np.eye(n_folds, dtype=np.int64)[to_fold])
+        fold[row] = to_fold
+        fold_counts[from_fold, labels] -= 1
+        fold_counts[to_fold, labels] += 1
+        desired[from_fold, labels] += 1
+        desired[to_fold, labels] -= 1
+        desired_total = desired_total + np.eye(n_folds)[from_fold] - np.eye(n_folds)[to_fold]
+
+    # reserve the min_counts, counting rows already reserved for other labels
+    n_row_labels = np.diff(row_ptr)
+    for j in np.argsort(remaining, kind='stable'):
+        missing = np.maximum(min_counts - fold_counts[:, j], 0)
+        if not missing.any():
+            continue
+        label_j_rows = label_rows[label_ptr[j]:label_ptr[j + 1]]
+        rows = rng.permutation(label_j_rows[fold[label_j_rows] == -1])
+        rows = rows[np.argsort(n_row_labels[rows], kind='stable')[:missing.sum()]]
+        # rows carrying more labels have fewer good folds, so they choose first
+        for row in rows[::-1]:
+            # the fold lacking this label where the row's other labels are least covered
+            labels = row_labels[row_ptr[row]:row_ptr[row + 1]]
+            covered = (fold_counts[:, labels] >= min_counts[:, None]).sum(axis=1)
+            f = np.argmin(np.where(missing > 0, covered, np.iinfo(np.int64).max))
+            move(row, f)
+            missing[f] -= 1
+
+    # a label whose rows all went to the wrong folds: move rows of it into a
+    # fold lacking it, each time the one leaving the fewest examples missing
+    for _ in range(100 * n_folds * n_labels):
+        short_folds, short_labels = np.nonzero(fold_counts < min_counts[:, None])
+        if short_folds.shape[0] == 0:
+            break
+        k = rng.integers(short_folds.shape[0])
+        f, j = short_folds[k], short_labels[k]
+        rows = label_rows[label_ptr[j]:label_ptr[j + 1]]
+        rows = rng.permutation(rows[fold[rows] != f])
+
+        missing_after = np.empty(rows.shape[0], dtype=np.int64)
+        for i, row in enumerate(rows):
+            g, labels = fold[row], row_labels[row_ptr[row]:row_ptr[row + 1]]
+            lost = (fold_counts[g, labels] <= min_counts[g]).sum() if g != -1 else 0
+            missing_after[i] = lost - (fold_counts[f, labels] < min_counts[f]).sum()
+        # an occasional random move keeps the search from cycling
+        move(rows[0] if rng.random() < 0.2 else rows[np.argmin(missing_after)], f)
+    if (fold_counts < min_counts[:, None]).any():
+        raise ValueError('Could not put min_count examples of every label in every fold.')
+
+    while (remaining > 0).any():
+        # the label with the fewest unassigned rows is the hardest to balance
+        j = np.argmin(np.where(remaining > 0, remaining, np.iinfo(np.int64).max))
+        rows = label_rows[label_ptr[j]:label_ptr[j + 1]]
+        rows = rng.permutation(rows[fold[rows] == -1])
+        assign(rows, _water_fill(desired[:, j], desired_total, rows.shape[0]))
+
+    # rows without any label only need to even out the fold sizes
+    rows = rng.permutation(np.flatnonzero(fold == -1))
+    assign(rows, _water_fill(desired_total, np.zeros(n_folds), rows.shape[0]))
+    return fold
+
+
+def multilabel_sample(y, size=1000, min_count=5, seed=None, n_jobs=None):
+    """ Takes a matrix of binary labels `y` and returns
+        the indices for a sample of size `size` if
+        `size` > 1 or `size` * len(y) if size =< 1.
+        The sample is guaranteed to have > `min_count` of
+        each label. `y` can be dense, a scipy sparse matrix
+        or a DataFrame with sparse columns.
+        Every label draws from its own stream spawned from
+        `seed`, so the sample is the same for any `n_jobs`.
+    """
+    choices, positions = _multilabel_sample_positions(y, size, min_count, seed, n_jobs)
+    return np.asarray(choices)[positions]
+
+
+def _draw_label_rows(label_choices, min_count, seed_seq):
+    return np.random.default_rng(seed_seq).choice(label_choices, size=min_count, replace=False)
+
+
+def _multilabel_sample_positions(y, size, min_count, seed, n_jobs=None):
+    """ `multilabel_sample` by row position: returns the row identifiers of
+        `y` and the positions of the sampled rows, in the order in which
+        `multilabel_sample` returns their identifiers.
+    """
+    choices, y, label_ptr, label_rows = _prepare_labels(y, min_count)
+    by_position = isinstance(choices, np.ndarray) or choices.is_monotonic_increasing
+
     if size <= 1:
         size = np.floor(y.shape[0] * size)
 
@@ -35,34 +277,33 @@ def multilabel_sample(y, size=1000, min_count=5, seed=None):
         warn(msg.format(y.shape[1] * min_count, size))
         size = y.shape[1] * min_count
 
-    rng = np.random.RandomState(seed if seed is not None else np.random.randint(1))
-
-    if isinstance(y, pd.DataFrame):
-        choices = y.index
-        y = y.values
-    else:
-        choices = np.arange(y.shape[0])
-
-    sample_idxs = np.array([], dtype=choices.dtype)
+    # one independent stream per label, plus one for the remainder
+    *label_seqs, remainder_seq = _seed_sequence(seed).spawn(y.shape[1] + 1)
 
     # first, guarantee > min_count of each label
-    for j in range(y.shape[1]):
-        label_choices = choices[y[:, j] == 1]
-        label_idxs_sampled = rng.choice(label_choices, size=min_count, replace=False)
-        sample_idxs = np.concatenate([label_idxs_sampled, sample_idxs])
+    label_draws = Parallel(n_jobs=effective_n_jobs(n_jobs), prefer="threads")(
+        delayed(_draw_label_rows)(label_rows[label_ptr[j]:label_ptr[j + 1]], min_count, label_seqs[j])
+        for j in range(y.shape[1]))
+    sampled = np.concatenate(label_draws + [np.empty(0, dtype=np.intp)])
 
-    sample_idxs = np.unique(sample_idxs)
+    is_sampled = np.zeros(y.shape[0], dtype=bool)
+    is_sampled[sampled] = True
+    sample_idxs = np.flatnonzero(is_sampled)
 
     # now that we have at least min_count of each, we can just random sample
     sample_count = int(size - sample_idxs.shape[0])
 
-    # get sample_count indices from remaining choices
-    remaining_choices = np.setdiff1d(choices, sample_idxs)
-    remaining_sampled = rng.choice(remaining_choices,
-                                   size=sample_count,
-                                   replace=False)
+    # get sample_count indices from remaining choices, in sorted order
+    remaining_choices = np.flatnonzero(~is_sampled)
+    if not by_position:
+        values = np.asarray(choices)
+        sample_idxs = sample_idxs[np.argsort(values[sample_idxs], kind='stable')]
+        remaining_choices = remaining_choices[np.argsort(values[remaining_choices], kind='stable')]
+    remaining_sampled = np.random.default_rng(remainder_seq).choice(remaining_choices,
+                                                                    size=sample_count,
+                                                                    replace=False)
 
-    return np.concatenate([sample_idxs, remaining_sampled])
+    return choices, np.concatenate([sample_idxs, remaining_sampled])
 
 
 def multilabel_sample_dataframe(df, labels, size, min_count=5, seed=None):
@@ -74,17 +315,173 @@ def multilabel_sample_dataframe(df, labels, size, min_count=5, seed=None):
     return df.loc[idxs]
 
 
-def multilabel_train_test_split(X, Y, size, min_count=5, seed=None):
+def _take_rows(X, positions):
+    """ Rows of `X` at `positions`: positional for DataFrames, CSR for COO. """
+    if isinstance(X, (pd.DataFrame, pd.Series)):
+        return X.iloc[positions]
+    if sparse.issparse(X) and X.format not in ('csr', 'csc'):
+        X = X.tocsr()
+    return X[positions]
+
+
+def multilabel_sample_stream(chunks, size, min_count=5, seed=None):
+    """ Single-pass version of `multilabel_sample` for label files that do
+        not fit in memory. `chunks` is an iterable of binary label matrices
+        with the same columns, e.g. `pd.read_csv(path, index_col=0,
+        chunksize=100000)` over an indicator file. Returns the identifiers
+        (DataFrame index, else running row number) of a sample of `size`
+        rows with at least `min_count` of each label.
+
+        Every row gets two independent uniform random keys. Each label
+        keeps the `min_count` rows with the smallest first keys holding
+        it, and the whole stream keeps the `size` + labels * `min_count`
+        smallest second keys, enough to fill the sample once the
+        guaranteed rows are taken out. Both are uniform samples of their
+        rows, so only O(labels * min_count + size) rows are held.
+    """
+    if size <= 1:
+        raise ValueError('multilabel_sample_stream needs an absolute size, the number of rows is not known up front.')
+
+    label_seq, remainder_seq = _seed_sequence(seed).spawn(2)
+    label_rng, remainder_rng = np.random.default_rng(label_seq), np.random.default_rng(remainder_seq)
+
+    n_labels = label_counts = None
+    label_keys = label_positions = label_ids = label_labels = None
+    keys = positions = ids = None
+    n_seen = 0
+
+    for chunk in chunks:
+        choices, y = _as_label_matrix(chunk)
+        if isinstance(chunk, (pd.DataFrame, pd.Series)):
+            chunk_ids = np.asarray(choices)
+        else:
+            chunk_ids = choices + n_seen
+        chunk_positions = np.arange(n_seen, n_seen + y.shape[0])
+        n_seen += y.shape[0]
+
+        if not np.isin(_label_values(y), [0, 1]).all():
+            raise ValueError('multilabel_sample only works with binary indicator matrices')
+
+        if n_labels is None:
+            n_labels = y.shape[1]
+            label_counts = np.zeros(n_labels, dtype=np.int64)
+            keys = label_keys = np.empty(0)
+            positions = label_positions = chunk_positions[:0]
+            ids = label_ids = chunk_ids[:0]
+            label_labels = np.empty(0, dtype=np.intp)
+            if n_labels * min_count > size:
+                msg = "Size less than number of columns * min_count, returning {} items instead of {}."
+                warn(msg.format(n_labels * min_count, size))
+                size = n_labels * min_count
+            n_kept = int(size) + n_labels * min_count
+        elif y.shape[1] != n_labels:
+            raise ValueError('All chunks must have the same label columns.')
+
+        chunk_keys = label_rng.random(y.shape[0])
+        row_ptr, row_labels = _row_labels(y)
+        rows = np.repeat(np.arange(y.shape[0]), np.diff(row_ptr))
+        label_counts += np.bincount(row_labels, minlength=n_labels)
+
+        # per label, keep the min_count smallest keys seen so far
+        label_keys = np.concatenate([label_keys, chunk_keys[rows]])
+        label_positions = np.concatenate([label_positions, chunk_positions[rows]])
+        label_ids = np.concatenate([label_ids, chunk_ids[rows]])
+        label_labels = np.concatenate([label_labels, row_labels])
+        order = np.lexsort((label_keys, label_labels))
+        group_ptr = np.concatenate([[0], np.cumsum(np.bincount(label_labels, minlength=n_labels))])
+        rank = np.arange(order.shape[0]) - np.repeat(group_ptr[:-1], np.diff(group_ptr))
+        order = order[rank < min_count]
+        label_keys, label_positions = label_keys[order], label_positions[order]
+        label_ids, label_labels = label_ids[order], label_labels[order]
+
+        # over all rows, keep the n_kept smallest independent keys seen so far
+        keys = np.concatenate([keys, remainder_rng.random(y.shape[0])])
+        positions = np.concatenate([positions, chunk_positions])
+        ids = np.concatenate([ids, chunk_ids])
+        if keys.shape[0] > n_kept:
+            keep = np.argpartition(keys, n_kept - 1)[:n_kept]
+            keys, positions, ids = keys[keep], positions[keep], ids[keep]
+
+    if label_counts is None or (label_counts < min_count).any():
+        raise ValueError('Some classes do not have enough examples. Change min_count if necessary.')
+    if n_seen < size:
+        raise ValueError('Cannot take a sample of {} rows from a stream of {}.'.format(int(size), n_seen))
+
+    # first the guaranteed rows, then the smallest keys among the others
+    guaranteed_positions, first = np.unique(label_positions, return_index=True)
+    sample_idxs = np.sort(label_ids[first])
+    others = ~np.isin(positions, guaranteed_positions)
+    order = np.argsort(keys[others])[:int(size) - sample_idxs.shape[0]]
+    remaining_sampled = ids[others][order]
+
+    return np.concatenate([sample_idxs, remaining_sampled])
+
+
+def multilabel_train_test_split(X, Y, size, min_count=5, seed=None, method='sample',
+                                return_indices=False, n_jobs=None):
     """ Takes a features matrix `X` and a label matrix `Y` and
         returns (X_train, X_test, Y_train, Y_test) where all
-        classes in Y are represented at least `min_count` times.
+        classes in Y are represented at least `min_count` times
+        in the test set. With `method`='iterative' the rows are
+        assigned by iterative stratification, so every label
+        also keeps about the same proportion in train and test.
+        With `return_indices`=True only the sorted row positions
+        (train_idxs, test_idxs) are returned, so nothing is copied.
+    """
+    if method not in ('sample', 'iterative'):
+        raise ValueError("method must be 'sample' or 'iterative'")
+
+    if method == 'iterative':
+        _, labels, label_ptr, label_rows = _prepare_labels(Y, min_count)
+        test_share = size if size <= 1 else size / labels.shape[0]
+        rng = np.random.default_rng(_seed_sequence(seed))
+        fold = _iterative_stratification(labels, label_ptr, label_rows,
+                                         [1 - test_share, test_share], [0, min_count], rng)
+        test_set_mask = fold == 1
+    else:
+        _, test_set_positions = _multilabel_sample_positions(Y, size, min_count, seed, n_jobs)
+        test_set_mask = np.zeros(Y.shape[0], dtype=bool)
+        test_set_mask[test_set_positions] = True
+
+    train_set_idxs = np.flatnonzero(~test_set_mask)
+    test_set_idxs = np.flatnonzero(test_set_mask)
+    if return_indices:
+        return train_set_idxs, test_set_idxs
+
+    return (_take_rows(X, train_set_idxs), _take_rows(X, test_set_idxs),
+            _take_rows(Y, train_set_idxs), _take_rows(Y, test_set_idxs))
+
+
+class MultilabelStratifiedKFold(BaseCrossValidator):
+    """ K-fold cross-validator for binary label matrices, usable as `cv` in
+        GridSearchCV or cross_val_score. The label structure is computed
+        once per `split` call and the folds come from one iterative
+        stratification pass, so they are disjoint, keep every label's
+        proportion and each test fold holds at least `min_count`
+        examples of every label. `random_state` is anything
+        np.random.default_rng accepts: an int, a SeedSequence,
+        a Generator or None.
     """
-    index = Y.index if isinstance(Y, pd.DataFrame) else np.arange(Y.shape[0])
+    def __init__(self, n_splits=5, min_count=1, random_state=None):
+        if n_splits < 2:
+            raise ValueError('n_splits must be at least 2.')
+        self.n_splits = n_splits
+        self.min_count = min_count
+        self.random_state = random_state
 
-    test_set_idxs = multilabel_sample(Y, size=size, min_count=min_count, seed=seed)
-    train_set_idxs = np.setdiff1d(index, test_set_idxs)
+    def split(self, X, y, groups=None):
+        fold = self.fold_assignments(y)
+        for k in range(self.n_splits):
+            is_test = fold == k
+            yield np.flatnonzero(~is_test), np.flatnonzero(is_test)
 
-    test_set_mask = index.isin(test_set_idxs)
-    train_set_mask = ~test_set_mask
+    def fold_assignments(self, y):
+        """ Returns the fold of every row of the label matrix `y`. """
+        _, y, label_ptr, label_rows = _prepare_labels(y, self.n_splits * self.min_count)
+        rng = np.random.default_rng(self.random_state)
+        return _iterative_stratification(y, label_ptr, label_rows,
+                                          np.full(self.n_splits, 1 / self.n_splits),
+                                          np.full(self.n_splits, self.min_count), rng)
 
-    return (X[train_set_mask], X[test_set_mask], Y[train_set_mask], Y[test_set_mask])
\ No newline at end of file
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits
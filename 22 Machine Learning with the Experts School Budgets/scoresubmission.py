@@ -6,10 +6,16 @@ Created on Sun Aug 11 22:59:32 2019
 @author: amin
 """
 PATH_TO_HOLDOUT_LABELS = 'https://s3.amazonaws.com/assets.datacamp.com/production/course_2826/datasets/TestSetLabelsSample.csv'
-PATH_TO_PREDICTIONS = 'data/predictions.csv'
+PATH_TO_PREDICTIONS = 'data/predictions.npy'
+import json
+from collections import namedtuple
+from itertools import zip_longest
+
 import pandas as pd
 import numpy as np
 
+from logloss import _compensated_add
+
 BOX_PLOTS_COLUMN_INDICES = [range(0, 37),
                             range(37, 48),
                             range(48, 51),
@@ -20,6 +26,24 @@ BOX_PLOTS_COLUMN_INDICES = [range(0, 37),
                             range(87, 96),
                             range(96, 104)]
 
+def _group_bounds(class_column_indices):
+    """ Returns the start of every group and the stop of the last one when
+        the groups are non-empty runs of consecutive columns following each
+        other, as BOX_PLOTS_COLUMN_INDICES are, and None otherwise.
+    """
+    starts = []
+    stop = None
+    for indices in class_column_indices:
+        indices = np.asarray(indices)
+        if indices.size == 0 or (np.diff(indices) != 1).any():
+            return None
+        if stop is not None and indices[0] != stop:
+            return None
+        starts.append(indices[0])
+        stop = indices[-1] + 1
+    return np.array(starts), stop
+
+
 def _multi_multi_log_loss(predicted,
                           actual,
                           class_column_indices=BOX_PLOTS_COLUMN_INDICES,
@@ -27,37 +51,357 @@ def _multi_multi_log_loss(predicted,
     """ Multi class version of Logarithmic Loss metric as implemented on
         DrivenData.org
     """
-    class_scores = np.ones(len(class_column_indices), dtype=np.float64)
+    entries = _entries_from_dummies(actual, class_column_indices)
+    sum_logs = _class_log_sums(predicted, entries, class_column_indices,
+                               _group_bounds(class_column_indices), eps)
+    class_scores = (-1.0 / np.shape(actual)[0]) * sum_logs
 
-    # calculate log loss for each set of columns that belong to a class:
+    return np.average(class_scores)
+
+
+def _multi_multi_log_loss_from_codes(predicted,
+                                     codes,
+                                     class_column_indices=BOX_PLOTS_COLUMN_INDICES,
+                                     eps=1e-15):
+    """ `_multi_multi_log_loss` with the true labels given as one integer
+        code per row and class instead of one-hot columns: codes[i, k] is
+        the position of row i's class within class_column_indices[k], or -1
+        when it is missing. Only the predicted probability of each true
+        class is gathered, so no dummy matrix is built.
+    """
+    entries = _entries_from_codes(codes, class_column_indices)
+    sum_logs = _class_log_sums(predicted, entries, class_column_indices,
+                               _group_bounds(class_column_indices), eps)
+    class_scores = (-1.0 / np.shape(codes)[0]) * sum_logs
+
+    return np.average(class_scores)
+
+
+# row, class and prediction column of every true label, with the weight
+# the DrivenData formula gives it (None when all weights are one)
+_TrueClassEntries = namedtuple('_TrueClassEntries', 'rows classes columns weights')
+
+
+def _entries_from_codes(codes, class_column_indices):
+    """ True class entries of labels given as one integer code per row and
+        class: codes[i, k] is the position of row i's class within
+        class_column_indices[k], or -1 when it is missing.
+    """
+    codes = np.asarray(codes)
+    rows, classes = np.nonzero(codes >= 0)
+    columns = np.empty(rows.shape[0], dtype=np.intp)
     for k, this_class_indices in enumerate(class_column_indices):
-        # get just the columns for this class
-        preds_k = predicted[:, this_class_indices].astype(np.float64)
+        in_class = classes == k
+        columns[in_class] = np.asarray(this_class_indices)[codes[rows[in_class], k]]
+    return _TrueClassEntries(rows, classes, columns, None)
 
-        # normalize so probabilities sum to one (unless sum is zero, then we clip)
-        preds_k /= np.clip(preds_k.sum(axis=1).reshape(-1, 1), eps, np.inf)
 
-        actual_k = actual[:, this_class_indices]
+def _entries_from_dummies(actual, class_column_indices):
+    """ True class entries of the non-zero one-hot `actual` columns,
+        weighted by their values.
+    """
+    actual = np.asarray(actual)
+    bounds = _group_bounds(class_column_indices)
+    if bounds is not None:
+        # one pass over the view of all groups
+        starts, stop = bounds
+        rows, columns = np.nonzero(actual[:, starts[0]:stop])
+        classes = np.searchsorted(starts - starts[0], columns, side='right') - 1
+        columns += starts[0]
+    else:
+        rows, classes, columns = [], [], []
+        for k, this_class_indices in enumerate(class_column_indices):
+            this_class_indices = np.asarray(this_class_indices)
+            rows_k, cols_k = np.nonzero(actual[:, this_class_indices])
+            rows.append(rows_k)
+            classes.append(np.full(rows_k.shape[0], k))
+            columns.append(this_class_indices[cols_k])
+        rows, classes, columns = (np.concatenate(a + [np.empty(0, dtype=np.intp)])
+                                  for a in (rows, classes, columns))
 
-        # shrink predictions so
-        y_hats = np.clip(preds_k, eps, 1 - eps)
-        sum_logs = np.sum(actual_k * np.log(y_hats))
-        class_scores[k] = (-1.0 / actual.shape[0]) * sum_logs
+    weights = actual[rows, columns]
+    if (weights == 1).all():
+        weights = None
+    return _TrueClassEntries(rows, classes, columns, weights)
 
-    return np.average(class_scores)
 
-def score_submission(pred_path=PATH_TO_PREDICTIONS, holdout_path=PATH_TO_HOLDOUT_LABELS):
+def _class_log_sums(predicted, entries, class_column_indices, bounds, eps):
+    """ Per class, the sum over rows of the log of the normalized, clipped
+        probability predicted for each true class entry. Leading axes of
+        `predicted` before (n_rows, n_columns) are kept. `bounds` is
+        `_group_bounds(class_column_indices)`.
+    """
+    predicted = np.asarray(predicted)
+    n_classes = len(class_column_indices)
+
+    # normalize so probabilities sum to one (unless sum is zero, then we clip)
+    if bounds is not None:
+        starts, stop = bounds
+        row_sums = np.add.reduceat(predicted[..., starts[0]:stop], starts - starts[0],
+                                   axis=-1, dtype=np.float64)
+    else:
+        row_sums = np.stack([predicted[..., np.asarray(indices)].sum(axis=-1, dtype=np.float64)
+                             for indices in class_column_indices], axis=-1)
+    row_sums = np.clip(row_sums, eps, np.inf)
+
+    # only the true class entries contribute to the loss
+    y_hats = np.clip(predicted[..., entries.rows, entries.columns] /
+                     row_sums[..., entries.rows, entries.classes],
+                     eps, 1 - eps)
+    logs = np.log(y_hats)
+    if entries.weights is not None:
+        logs *= entries.weights
+
+    # one bincount over all leading axes, each offset by n_classes
+    n_lead = int(np.prod(predicted.shape[:-2]))
+    bins = (np.arange(n_lead)[:, None] * n_classes + entries.classes).ravel()
+    sum_logs = np.bincount(bins, weights=logs.ravel(), minlength=n_lead * n_classes)
+    return sum_logs.reshape(predicted.shape[:-2] + (n_classes,))
+
+
+class MultiMultiLogLossAccumulator(object):
+    """ `_multi_multi_log_loss` over batches of rows, for predictions that
+        arrive in batches and are not kept. The per-class log sums of each
+        batch are added with compensated summation, so `result` matches the
+        batch function on all the rows to within floating point rounding.
+        Accumulators fed different batches can be combined with `merge`.
+    """
+    def __init__(self, class_column_indices=BOX_PLOTS_COLUMN_INDICES, eps=1e-15):
+        self.class_column_indices = class_column_indices
+        self.eps = eps
+        self.sum_logs = np.zeros(len(class_column_indices), dtype=np.float64)
+        self.compensation = np.zeros_like(self.sum_logs)
+        self.n_rows = 0
+        self._bounds = _group_bounds(class_column_indices)
+
+    def update(self, predicted, actual):
+        """ Adds a batch of predictions and their one-hot actual labels. """
+        return self._update(predicted, _entries_from_dummies(actual, self.class_column_indices))
+
+    def update_codes(self, predicted, codes):
+        """ Adds a batch of predictions with the true labels given as one
+            integer code per row and class, -1 when missing.
+        """
+        return self._update(predicted, _entries_from_codes(codes, self.class_column_indices))
+
+    def _update(self, predicted, entries):
+        batch_sums = _class_log_sums(predicted, entries, self.class_column_indices,
+                                     self._bounds, self.eps)
+        self.sum_logs, self.compensation = _compensated_add(self.sum_logs, self.compensation,
+                                                            batch_sums)
+        self.n_rows += np.shape(predicted)[0]
+        return self
+
+    def merge(self, other):
+        """ Adds the rows seen by another accumulator to this one. """
+        self.sum_logs, self.compensation = _compensated_add(self.sum_logs,
+                                                            self.compensation + other.compensation,
+                                                            other.sum_logs)
+        self.n_rows += other.n_rows
+        return self
+
+    def result(self):
+        """ The score of all rows added so far. """
+        if not self.n_rows:
+            raise ValueError("No rows have been added.")
+        return np.average((-1.0 / self.n_rows) * (self.sum_logs + self.compensation))
+
+
+def _encode_holdout(holdout):
+    """ Takes the holdout labels, one column per class, and returns the
+        integer code of every label and the column names pd.get_dummies
+        would give them, so both can be checked against the predictions.
+    """
+    categoricals = [holdout[column].astype('category') for column in holdout.columns]
+    columns = ['{}_{}'.format(column, category)
+               for column, categorical in zip(holdout.columns, categoricals)
+               for category in categorical.cat.categories]
+    codes = np.column_stack([categorical.cat.codes.values for categorical in categoricals])
+    return codes, columns
+
+
+def _encode_holdout_by_columns(holdout, pred_columns, class_column_indices):
+    """ Encodes the holdout labels against the prediction columns of each
+        class, named like pd.get_dummies names them, for when the holdout
+        is only seen a chunk at a time. Missing labels get -1.
+    """
+    codes = np.empty(holdout.shape, dtype=np.int64)
+    for k, (label, this_class_indices) in enumerate(zip(holdout.columns, class_column_indices)):
+        prefix = '{}_'.format(label)
+        class_columns = [pred_columns[j] for j in this_class_indices]
+        assert all(column.startswith(prefix) for column in class_columns)
+
+        categories = {column[len(prefix):]: j for j, column in enumerate(class_columns)}
+        values = holdout[label]
+        codes[:, k] = values.map(categories).fillna(-1).values
+        # every label present in the holdout needs a prediction column
+        assert not (values.notna().values & (codes[:, k] < 0)).any()
+    return codes
+
+
+class HoldoutScorer(object):
+    """ DrivenData multi class log loss against one set of holdout labels,
+        for scoring many prediction matrices. The labels are encoded, and
+        the rows and columns of the true classes and the class boundaries
+        are worked out once; `score` then only gathers and sums, with no
+        validation beyond the shape. Predictions of several models can be
+        stacked into one (n_models, n_rows, n_columns) array and scored
+        together with `score_batch`.
+    """
+    def __init__(self, holdout, class_column_indices=BOX_PLOTS_COLUMN_INDICES, eps=1e-15):
+        self.codes, self.columns = _encode_holdout(holdout)
+        self.index = holdout.index
+        self.labels = list(holdout.columns)
+        self.class_column_indices = class_column_indices
+        self.eps = eps
+
+        self._entries = _entries_from_codes(self.codes, class_column_indices)
+        self._bounds = _group_bounds(class_column_indices)
+
+    def check(self, index, columns):
+        """ Asserts that predictions with this `index` and `columns` line
+            up with the holdout labels.
+        """
+        assert list(columns) == self.columns
+        assert pd.Index(index).equals(self.index)
+
+    def score(self, predicted):
+        """ Log loss of the (n_rows, n_columns) `predicted` probabilities,
+            whose rows and columns are assumed to follow the holdout.
+        """
+        return np.average(self.class_scores(predicted))
+
+    def score_batch(self, predicted):
+        """ Takes `predicted` of shape (n_models, n_rows, n_columns) and
+            returns the overall log loss of each model, shape (n_models,),
+            and the log loss of each model on each class, shape
+            (n_models, n_classes), in one pass over the stack.
+        """
+        class_scores = self.class_scores(predicted)
+        return class_scores.mean(axis=-1), class_scores
+
+    def class_scores(self, predicted):
+        """ Log loss of `predicted` for each class separately. Leading axes
+            of `predicted` before (n_rows, n_columns) are kept.
+        """
+        predicted = np.asarray(predicted)
+        assert predicted.shape[-2:] == (self.codes.shape[0], len(self.columns))
+
+        sum_logs = _class_log_sums(predicted, self._entries, self.class_column_indices,
+                                   self._bounds, self.eps)
+        return (-1.0 / self.codes.shape[0]) * sum_logs
+
+
+def write_predictions(prediction_df, path, dtype=np.float32):
+    """ Writes `prediction_df` for `score_submission`, in a format chosen by
+        the extension of `path`:
+        .npy     -- `dtype` values, memory-mappable, with the columns and
+                    index in a JSON sidecar at `path` + '.json'
+        .parquet -- DataFrame.to_parquet (needs pyarrow or fastparquet)
+        other    -- CSV, as before
+        float32 rounds each probability by up to 2**-24 relative, which
+        can move the score by up to about 1e-7; the errors mostly cancel,
+        typically leaving 1e-12 to 1e-9. Pass dtype=np.float64 to score
+        exactly.
+    """
+    if path.endswith('.npy'):
+        np.save(path, np.ascontiguousarray(prediction_df.values, dtype=dtype))
+        with open(path + '.json', 'w') as f:
+            json.dump({'columns': [str(column) for column in prediction_df.columns],
+                       'index': prediction_df.index.tolist(),
+                       'index_name': prediction_df.index.name}, f)
+    elif path.endswith('.parquet'):
+        prediction_df.to_parquet(path)
+    else:
+        prediction_df.to_csv(path)
+
+
+def _iter_predictions(path, chunksize=None):
+    """ Yields (values, index, columns) of the predictions written to `path`
+        by `write_predictions`, whole or `chunksize` rows at a time. Values
+        of .npy files are slices of a read-only memory map.
+    """
+    if path.endswith('.npy'):
+        values = np.load(path, mmap_mode='r')
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        index = pd.Index(meta['index'], name=meta['index_name'])
+        step = chunksize or max(values.shape[0], 1)
+        for start in range(0, values.shape[0], step):
+            yield values[start:start + step], index[start:start + step], meta['columns']
+    elif path.endswith('.parquet') and chunksize is not None:
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            preds = batch.to_pandas()
+            yield preds.values, preds.index, list(preds.columns)
+    else:
+        if path.endswith('.parquet'):
+            chunks = [pd.read_parquet(path)]
+        elif chunksize is None:
+            chunks = [pd.read_csv(path, index_col=0)]
+        else:
+            chunks = pd.read_csv(path, index_col=0, chunksize=chunksize)
+        for preds in chunks:
+            yield preds.values, preds.index, list(preds.columns)
+
+
+def _score_submission_chunked(pred_path, holdout_path, chunksize,
+                              class_column_indices=BOX_PLOTS_COLUMN_INDICES,
+                              eps=1e-15):
+    """ `score_submission` reading both files `chunksize` rows at a time and
+        accumulating the per-class log sums, so memory does not grow with
+        the number of rows.
+    """
+    labels = pd.read_csv(holdout_path, index_col=0, nrows=0).columns
+    holdout_chunks = pd.read_csv(holdout_path, index_col=0, chunksize=chunksize,
+                                 dtype={label: str for label in labels})
+    pred_chunks = _iter_predictions(pred_path, chunksize)
+
+    accumulator = MultiMultiLogLossAccumulator(class_column_indices, eps)
+    for preds, holdout in zip_longest(pred_chunks, holdout_chunks):
+        # make sure that format is correct
+        assert preds is not None and holdout is not None
+        values, index, columns = preds
+        assert index.equals(holdout.index)
+
+        codes = _encode_holdout_by_columns(holdout, columns, class_column_indices)
+        accumulator.update_codes(values, codes)
+
+    return accumulator.result()
+
+
+def score_submissions(pred_paths, holdout_path=PATH_TO_HOLDOUT_LABELS):
+    """ Scores the predictions written to each of `pred_paths` against one
+        holdout. Returns a DataFrame indexed by path, with the log loss on
+        each label and the overall score. The holdout is encoded once and
+        .npy predictions are read through their memory maps, one file at a
+        time, rather than stacked.
+    """
+    scorer = HoldoutScorer(pd.read_csv(holdout_path, index_col=0))
+
+    class_scores = []
+    for pred_path in pred_paths:
+        values, index, columns = next(_iter_predictions(pred_path))
+        scorer.check(index, columns)
+        class_scores.append(scorer.class_scores(values))
+
+    scores = pd.DataFrame(class_scores, index=list(pred_paths), columns=scorer.labels)
+    scores['overall'] = scores.mean(axis=1)
+    return scores
+
+
+def score_submission(pred_path=PATH_TO_PREDICTIONS, holdout_path=PATH_TO_HOLDOUT_LABELS,
+                     chunksize=None):
     # this happens on the backend to get the score
-    holdout_labels = pd.get_dummies(
-                        pd.read_csv(holdout_path, index_col=0)
-                          .apply(lambda x: x.astype('category'), axis=0)
-                      )
+    # the predictions format (.npy, .parquet or CSV) follows from pred_path
+    if chunksize is not None:
+        return _score_submission_chunked(pred_path, holdout_path, chunksize)
+
+    scorer = HoldoutScorer(pd.read_csv(holdout_path, index_col=0))
+    values, index, columns = next(_iter_predictions(pred_path))
 
-    preds = pd.read_csv(pred_path, index_col=0)
-    
     # make sure that format is correct
-    assert (preds.columns == holdout_labels.columns).all()
-    assert (preds.index == holdout_labels.index).all()
+    scorer.check(index, columns)
 
-    return _multi_multi_log_loss(preds.values, holdout_labels.values)
+    return scorer.score(values)
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the iterative stratification in multilabel.py: any
+label matrix passing validation must split with min_count examples of
+every label where they are asked for.
+"""
+
+import numpy as np
+import pytest
+
+from multilabel import MultilabelStratifiedKFold, multilabel_train_test_split
+
+
+def _random_labels(seed, n_rows, n_labels, low, high):
+    """ A binary label matrix whose labels each sit on between `low` and
+        `high` - 1 random rows.
+    """
+    rng = np.random.default_rng(seed)
+    y = np.zeros((n_rows, n_labels), dtype=np.int64)
+    for j, count in enumerate(rng.integers(low, high, n_labels)):
+        y[rng.choice(n_rows, count, replace=False), j] = 1
+    return y
+
+
+@pytest.mark.parametrize('seed', range(0, 2000, 20))
+def test_iterative_split_keeps_min_count(seed):
+    min_count = 3
+    for offset in range(20):
+        y = _random_labels(seed + offset, 60, 6, min_count, 8)
+        train, test = multilabel_train_test_split(y, y, 0.2, min_count=min_count, seed=seed + offset,
+                                                  method='iterative', return_indices=True)
+        assert (y[test].sum(axis=0) >= min_count).all()
+        assert np.array_equal(np.sort(np.concatenate([train, test])), np.arange(y.shape[0]))
+
+
+@pytest.mark.parametrize('seed', range(0, 1000, 20))
+def test_kfold_keeps_min_count(seed):
+    for offset in range(20):
+        y = _random_labels(seed + offset, 80, 8, 5, 12)
+        cv = MultilabelStratifiedKFold(n_splits=5, min_count=1, random_state=seed + offset)
+        for _, test in cv.split(y, y):
+            assert (y[test].sum(axis=0) >= 1).all()
+
+
+def test_kfold_rare_labels_sharing_rows():
+    # labels 0 and 1 need all their rows in distinct folds, and label 2 only
+    # reaches every fold if their rows carrying it do not share folds
+    y = np.zeros((7, 3), dtype=np.int64)
+    y[[0, 1, 2], 0] = 1
+    y[[3, 4, 5], 1] = 1
+    y[[0, 3, 6], 2] = 1
+    for seed in range(50):
+        cv = MultilabelStratifiedKFold(n_splits=3, min_count=1, random_state=seed)
+        for _, test in cv.split(y, y):
+            assert (y[test].sum(axis=0) >= 1).all()
+
+
+def test_kfold_impossible_split_raises():
+    # every pair of the three rows shares a label, so two folds cannot
+    # both hold all three labels
+    y = np.array([[1, 1, 0],
+                  [1, 0, 1],
+                  [0, 1, 1]])
+    with pytest.raises(ValueError):
+        MultilabelStratifiedKFold(n_splits=2, min_count=1, random_state=0).fold_assignments(y)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests for SparseInteractions.py.
+"""
+
+from collections import Counter
+from itertools import combinations
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from SparseInteractions import SparseInteractions, _combination_columns, _combination_support
+
+
+def _reference_interactions(X, degree):
+    """ The output and feature names of the original SparseInteractions,
+        which multiplied the columns of every combination one at a time.
+    """
+    X = sparse.csc_matrix(X)
+    names = [str(i) for i in range(X.shape[1])]
+    out_mat = []
+    for sub_degree in range(2, degree + 1):
+        for col_ixs in combinations(range(X.shape[1]), sub_degree):
+            names.append('_'.join(str(j) for j in col_ixs))
+            out = X[:, col_ixs[0]]
+            for j in col_ixs[1:]:
+                out = out.multiply(X[:, j])
+            out_mat.append(out)
+    return sparse.hstack([X] + out_mat).toarray(), names
+
+
+def _random_input(seed, n_rows, n_cols):
+    X = sparse.random(n_rows, n_cols, density=np.random.RandomState(seed).uniform(0.05, 0.8),
+                      format='csr', random_state=seed)
+    # rounding leaves some explicit zeros in the stored entries
+    X.data = np.round(X.data * 5)
+    return X
+
+
+@pytest.mark.parametrize('n_jobs', [None, 3])
+@pytest.mark.parametrize('degree', [1, 2, 3])
+@pytest.mark.parametrize('fmt', ['csc', 'csr', 'dense'])
+def test_transform_matches_reference(fmt, degree, n_jobs):
+    for seed in range(4):
+        X = _random_input(seed, 60, 9)
+        expected, expected_names = _reference_interactions(X, degree)
+        inp = X.toarray() if fmt == 'dense' else X.asformat(fmt)
+
+        model = SparseInteractions(degree=degree, n_jobs=n_jobs)
+        out = model.fit_transform(inp)
+        assert out.format == ('csc' if fmt == 'csc' else 'csr')
+        assert np.array_equal(out.toarray(), expected)
+        assert model.get_feature_names().tolist() == expected_names
+
+        blocks = list(model.iter_transform(inp, batch_size=17))
+        assert np.array_equal(sparse.vstack(blocks).toarray(), expected)
+
+
+@pytest.mark.parametrize('n_jobs', [None, 3])
+@pytest.mark.parametrize('degree', [2, 3])
+@pytest.mark.parametrize('fmt', ['csc', 'csr', 'dense'])
+def test_min_support_matches_reference(fmt, degree, n_jobs):
+    for seed, min_support in zip(range(4), [1, 2, 3, 5]):
+        X_train, X_test = _random_input(seed, 60, 8), _random_input(seed + 100, 30, 8)
+        train, names = _reference_interactions(X_train, degree)
+        test, _ = _reference_interactions(X_test, degree)
+        keep = (train != 0).sum(axis=0) >= min_support
+        keep[:X_train.shape[1]] = True
+
+        model = SparseInteractions(degree=degree, min_support=min_support, n_jobs=n_jobs)
+        model.fit(X_train.toarray() if fmt == 'dense' else X_train.asformat(fmt))
+        out = model.transform(X_test.toarray() if fmt == 'dense' else X_test.asformat(fmt))
+        assert np.array_equal(out.toarray(), test[:, keep])
+        assert model.get_feature_names().tolist() == [n for n, k in zip(names, keep) if k]
+
+
+@pytest.mark.parametrize('min_support', [None, 2])
+def test_feature_name_slices(min_support):
+    X = np.random.default_rng(0).integers(0, 2, (20, 10))
+    names = SparseInteractions(degree=3, min_support=min_support).fit(X).get_feature_names()
+    expected = names.tolist()
+    assert expected == [names[j] for j in range(len(names))]
+
+    n = len(names)
+    for start in (None, 0, 2, 15, n - 1, -3, n + 5):
+        for stop in (None, 0, 2, 15, n - 1, -3, n + 5):
+            for step in (None, 1, 2, 7, -1, -2, -7):
+                assert names[start:stop:step] == expected[start:stop:step]
+
+
+@pytest.mark.parametrize('n_jobs', [None, 3])
+@pytest.mark.parametrize('degree', [2, 3])
+def test_min_support_on_wide_input(degree, n_jobs):
+    # far more possible combinations than could be counted densely
+    X = sparse.random(2000, 8000, density=0.0015, format='csr', random_state=0)
+    support = Counter(tuple_ for row in range(X.shape[0])
+                      for tuple_ in combinations(X[row].indices, degree))
+    expected = sorted(tuple_ for tuple_, count in support.items() if count >= 2)
+
+    model = SparseInteractions(degree=degree, min_support=2, n_jobs=n_jobs).fit(X)
+    assert [tuple(cols) for cols in model.interactions_[-1]] == expected
+
+
+def test_combination_support_merges_batches():
+    X = sparse.random(500, 40, density=0.1, format='csr', random_state=1)
+    support = Counter(tuple_ for row in range(X.shape[0])
+                      for tuple_ in combinations(X[row].indices, 2))
+
+    batches = [(start, min(start + 7, X.shape[0])) for start in range(0, X.shape[0], 7)]
+    ranks, counts = _combination_support(X, 2, batches)
+    tuples = zip(*(cols.tolist() for cols in _combination_columns(ranks, X.shape[1], 2)))
+    assert dict(zip(tuples, counts.tolist())) == support